@@ -1,26 +1,91 @@
-import json
+import hashlib
+import importlib.util
+import itertools
+import math
 import os
 import random
 import re
+import shelve
 import time
 from datetime import datetime
 
 import anthropic
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
 import trio
 
 API_KEY = os.environ["ANTHROPIC_API_KEY"]
-client = anthropic.Anthropic(api_key=API_KEY)
+# One long-lived connection pool for the whole run. With h2 installed, requests
+# are multiplexed over HTTP/2 instead of each needing its own TLS connection.
+client = anthropic.AsyncAnthropic(
+    api_key=API_KEY,
+    timeout=httpx.Timeout(120.0, connect=10.0),
+    http_client=httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=64, max_keepalive_connections=64, keepalive_expiry=120.0
+        ),
+    ),
+)
+# Streams share the pool but not the SDK's retries, since get_claude_completion
+# retries them itself; batch calls keep the SDK's retries.
+streaming_client = client.with_options(max_retries=0)
 
 MAX_TOKENS = 4096
-CAPACITY_LIMIT = 1  # Increase this if you have an API key that supports calling the model more times in parallel!
-
-# Global counters
-warning_counts = {}  # Tracks missing completion tags in continuations per model
-continuation_calls_per_model = {}  # Tracks number of continuation calls per model
-calls_per_model = {}  # Tracks total calls per model
+# Results are appended here one prompt per line as prompts finish; prompts
+# already in the file are skipped, so delete it to start a fresh run.
+RESULTS_JSONL_PATH = "star_chameleon_results.jsonl"
+RESULTS_PATH = "star_chameleon_results.json"  # Consolidated results, written at the end
+SEED = 0  # Seeds the prompt order and candidate shuffles
+CAPACITY_LIMIT = 8  # Max in-flight API calls; set to 1 if your API key's rate limit can't take the parallelism.
+
+# Shared across all prompts so the limit applies to individual API calls
+api_limiter = trio.CapacityLimiter(CAPACITY_LIMIT)
+
+MAX_ATTEMPTS = 5  # Tries per API call before giving up on it
+RETRY_BASE_DELAY = 2  # Seconds; doubles with each retry, plus up to a second of jitter
+RETRY_MAX_DELAY = 60
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "api_error", "rate_limit_error"}
+
+# Client-side limits matching the API key's tier, so requests are paced instead
+# of bouncing off 429s. Defaults are tier 1; raise them via the environment.
+RPM_LIMIT = int(os.environ.get("RPM_LIMIT", 40))  # Requests per minute
+TPM_LIMIT = int(os.environ.get("TPM_LIMIT", 16000))  # Tokens per minute
+
+USE_BATCH_API = False  # Set to True to send requests as Message Batches: half the price, but results can take hours.
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
+BATCH_SIZE = 32  # Submit a batch once this many requests are queued...
+FLUSH_MS = 2000  # ...or once the oldest queued request has waited this long
+MAX_CONCURRENT_BATCHES = 4  # Batches in flight at once across all prompts
+
+# Mark shared prompt prefixes (prompt + first half of a story) as cacheable.
+# The cache is per model, so this only pays off when the same model re-reads a
+# prefix within the cache lifetime, e.g. when retrying or rerunning; cache
+# writes cost more than uncached input tokens, so it is off by default.
+PROMPT_CACHING = False
+
+# Set to a file path to store every response on disk and reuse it for identical
+# requests. A crashed run then resumes where it stopped, but note that reruns
+# replay the stored samples instead of drawing new ones at temperature 0.7.
+RESPONSE_CACHE_PATH = None
+
+RANK_LINE_RE = re.compile(r"\s*\d+\.\s*(\d+)\s*")  # "1. 3" -> 3, whole line
+
+# Global counters, indexed by AIModel.id
+model_names = []  # Model name for each id
+model_ids = {}  # Id for each model name
+warning_counts = np.zeros(0, dtype=np.int64)  # Missing completion tags in continuations
+continuation_calls_per_model = np.zeros(0, dtype=np.int64)  # Continuation calls
+calls_per_model = np.zeros(0, dtype=np.int64)  # Total calls
+fooled_others_counts = np.zeros(0, dtype=np.int64)  # Times others picked its fake
+got_fooled_counts = np.zeros(0, dtype=np.int64)  # Wrong guesses made by this model
 total_calls = 0
 total_expected_calls = 0  # Will be set in star_chameleon
+progress_checkpoint = 0  # total_calls // 50 when progress was last logged
+batch_scheduler = None  # Set in star_chameleon when USE_BATCH_API is on
+response_cache = None  # Shelf opened in star_chameleon when RESPONSE_CACHE_PATH is set
 
 
 def log(message):
@@ -32,82 +97,359 @@ class AIModel:
     def __init__(self, model_name, provider):
         self.model_name = model_name
         self.provider = provider
+        self.id = None  # Index into the per-model counter arrays, set in star_chameleon
 
 
-async def get_claude_completion(
-    prompt: str, model: str, is_continuation: bool = False
-) -> str:
-    global total_calls, calls_per_model, continuation_calls_per_model
+def message_params(messages: list[dict], model: str) -> dict:
+    return {
+        "model": model,
+        "max_tokens": MAX_TOKENS,
+        "messages": messages,
+        "temperature": 0.7,
+    }
+
+
+def user_message(prefix: str, rest: str = "") -> list[dict]:
+    """Build a single user turn, splitting off a shared prefix that can be served from the prompt cache."""
+    prefix_block = {"type": "text", "text": prefix}
+    if PROMPT_CACHING:
+        prefix_block["cache_control"] = {"type": "ephemeral"}
+    content = [prefix_block]
+    if rest:
+        content.append({"type": "text", "text": rest})
+    return [{"role": "user", "content": content}]
+
+
+def count_call(model: AIModel, is_continuation: bool = False):
+    global total_calls
     total_calls += 1
-    calls_per_model[model] = calls_per_model.get(model, 0) + 1
+    calls_per_model[model.id] += 1
     if is_continuation:
-        continuation_calls_per_model[model] = (
-            continuation_calls_per_model.get(model, 0) + 1
-        )
+        continuation_calls_per_model[model.id] += 1
+
 
-    if total_calls % 50 == 0:
+def count_guess(guess: dict):
+    """Add a guess record to the interim fooling counters."""
+    if guess["guessed_model"] == guess["original_model"]:
+        return
+    # Resumed records may name models that aren't in this run
+    guessing_id = model_ids.get(guess["guessing_model"])
+    if guessing_id is not None:
+        got_fooled_counts[guessing_id] += 1
+    guessed_id = model_ids.get(guess["guessed_model"])
+    if guessed_id is not None:
+        fooled_others_counts[guessed_id] += 1
+
+
+def maybe_log_progress():
+    """Log progress, completion tag status and fooling results each time another 50 calls have gone out."""
+    global progress_checkpoint
+    if total_calls // 50 == progress_checkpoint:
+        return
+    progress_checkpoint = total_calls // 50
+
+    log(
+        f"Progress: {total_calls}/{total_expected_calls} calls completed ({(total_calls/total_expected_calls)*100:.1f}%)"
+    )
+
+    # Print completion tag warnings
+    log("\nCompletion tag status:")
+    for model_id, model_name in enumerate(model_names):
+        warnings = warning_counts[model_id]
+        cont_calls = continuation_calls_per_model[model_id]
+        warning_ratio = warnings / cont_calls if cont_calls > 0 else 0
         log(
-            f"Progress: {total_calls}/{total_expected_calls} calls completed ({(total_calls/total_expected_calls)*100:.1f}%)"
+            f"  {model_name}: {warnings}/{cont_calls} missing tags in continuations ({warning_ratio:.1%})"
         )
 
-        # Print completion tag warnings
-        log("\nCompletion tag status:")
-        for model_name in warning_counts:
-            warnings = warning_counts[model_name]
-            cont_calls = continuation_calls_per_model.get(model_name, 0)
-            warning_ratio = warnings / cont_calls if cont_calls > 0 else 0
-            log(
-                f"  {model_name}: {warnings}/{cont_calls} missing tags in continuations ({warning_ratio:.1%})"
-            )
+    print_fooling_results()
+
+
+async def stream_completion(params: dict) -> str:
+    """Stream a response, hanging up as soon as the closing </completion> tag arrives."""
+    text = ""
+    async with streaming_client.messages.stream(**params) as stream:
+        async for delta in stream.text_stream:
+            text += delta
+            # Only the new delta (plus a tag's length of overlap) can complete the tag
+            if "</completion>" in text[-len(delta) - len("</completion>") :]:
+                break
+    return text
+
+
+def cache_key(messages: list[dict], model: str) -> str:
+    digest = hashlib.blake2b(orjson.dumps(messages), digest_size=16)
+    return f"{model}:{digest.hexdigest()}"
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, overloads, server errors and dropped connections are worth retrying."""
+    if isinstance(
+        error,
+        (anthropic.RateLimitError, anthropic.APIConnectionError, httpx.TransportError),
+    ):
+        return True
+    if not isinstance(error, anthropic.APIStatusError):
+        return False
+    if error.status_code >= 500:
+        return True
+    # Errors sent mid-stream carry the stream's 200 status, so go by the error type
+    body = error.body
+    return (
+        isinstance(body, dict)
+        and isinstance(body.get("error"), dict)
+        and body["error"].get("type") in RETRYABLE_ERROR_TYPES
+    )
 
-    try:
-        response = await trio.to_thread.run_sync(
-            lambda: client.messages.create(
-                model=model,
-                max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7,
-            )
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Rough request size for rate limiting: ~4 characters per input token, plus the full output budget."""
+    chars = sum(
+        len(block["text"]) for message in messages for block in message["content"]
+    )
+    return chars // 4 + MAX_TOKENS
+
+
+class DualBucket:
+    """Requests-per-minute and tokens-per-minute token buckets; acquire() waits until both have room."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)  # Both buckets start full
+        self.tokens = float(tpm)
+        self.updated = None  # trio clock time of the last refill
+        self.lock = trio.Lock()  # Waiters are served in arrival order
+
+    def refill(self):
+        now = trio.current_time()
+        if self.updated is not None:
+            # Each trio.run has its own clock offset, so a time left over
+            # from an earlier run can be ahead of now
+            minutes = max(0.0, now - self.updated) / 60
+            self.requests = min(self.rpm, self.requests + minutes * self.rpm)
+            self.tokens = min(self.tpm, self.tokens + minutes * self.tpm)
+        self.updated = now
+
+    async def acquire(self, tokens: int):
+        # A request bigger than the whole bucket would otherwise wait forever
+        tokens = min(tokens, self.tpm)
+        async with self.lock:
+            self.refill()
+            while self.requests < 1 or self.tokens < tokens:
+                await trio.sleep(
+                    60
+                    * max(
+                        (1 - self.requests) / self.rpm,
+                        (tokens - self.tokens) / self.tpm,
+                    )
+                )
+                self.refill()
+            self.requests -= 1
+            self.tokens -= tokens
+
+
+# Shared across all prompts, like api_limiter; only direct requests go through it
+rate_limiter = DualBucket(RPM_LIMIT, TPM_LIMIT)
+
+
+async def get_claude_completion(
+    messages: list[dict],
+    model: AIModel,
+    is_continuation: bool = False,
+    stage: str = "request",
+) -> str | None:
+    """Return the completion, or None if retries ran out; errors that retrying won't fix are raised."""
+    count_call(model, is_continuation)
+    key = cache_key(messages, model.model_name) if response_cache is not None else None
+    if key is not None and key in response_cache:
+        return extract_completion(response_cache[key], model, is_continuation)
+
+    if batch_scheduler is not None:
+        text = await batch_scheduler.complete(
+            stage, message_params(messages, model.model_name)
         )
-        return extract_completion(response.content[0].text, model, is_continuation)
-    except Exception as e:
-        log(f"Error getting completion from {model}: {e}")
-        return ""
+        if text is None:
+            return None
+    else:
+        tokens = estimate_tokens(messages)
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await rate_limiter.acquire(tokens)
+                async with api_limiter:
+                    text = await stream_completion(
+                        message_params(messages, model.model_name)
+                    )
+                break
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if attempt == MAX_ATTEMPTS - 1:
+                    log(f"Error getting completion from {model.model_name}: {e}")
+                    return None
+                delay = min(
+                    RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt + random.random()
+                )
+                log(f"Retrying {model.model_name} in {delay:.1f}s after error: {e}")
+                await trio.sleep(delay)
+
+    if key is not None and text:
+        response_cache[key] = text
+    return extract_completion(text, model, is_continuation)
+
+
+async def submit_batch(requests: list[dict]) -> list[str | None]:
+    """Send requests ({"custom_id", "params"}) as one Message Batch and return the raw response texts in request order (None where a request failed)."""
+    batch = await client.messages.batches.create(requests=requests)
+    log(f"Submitted batch {batch.id} with {len(requests)} requests")
+    while batch.processing_status != "ended":
+        await trio.sleep(BATCH_POLL_INTERVAL)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    texts = {}
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            texts[entry.custom_id] = entry.result.message.content[0].text
+        else:
+            log(f"Error in batch {batch.id}: {entry.custom_id} {entry.result.type}")
+    return [texts.get(request["custom_id"]) for request in requests]
+
+
+class BatchScheduler:
+    """Groups requests from all prompts into mid-sized Message Batches, several of which can be in flight at once."""
+
+    def __init__(self):
+        self.send_channel, self.receive_channel = trio.open_memory_channel(math.inf)
+        self.batch_limiter = trio.CapacityLimiter(MAX_CONCURRENT_BATCHES)
+        self.request_ids = itertools.count()
+        self.pending = {}  # custom_id -> trio.Event set once the result arrives
+        self.texts = {}  # custom_id -> raw response text
+
+    async def complete(self, stage: str, params: dict) -> str | None:
+        custom_id = f"{stage}_{next(self.request_ids)}"
+        done = self.pending[custom_id] = trio.Event()
+        await self.send_channel.send({"custom_id": custom_id, "params": params})
+        await done.wait()
+        return self.texts.pop(custom_id)
+
+    async def run(self):
+        async with self.receive_channel, trio.open_nursery() as nursery:
+            while True:
+                try:
+                    batch = [await self.receive_channel.receive()]
+                except trio.EndOfChannel:
+                    break
+                with trio.move_on_after(FLUSH_MS / 1000):
+                    while len(batch) < BATCH_SIZE:
+                        try:
+                            batch.append(await self.receive_channel.receive())
+                        except trio.EndOfChannel:
+                            break
+                nursery.start_soon(self.submit, batch)
+
+    async def submit(self, requests: list[dict]):
+        async with self.batch_limiter:
+            texts = await submit_batch(requests)
+        for request, text in zip(requests, texts):
+            self.texts[request["custom_id"]] = text
+            self.pending.pop(request["custom_id"]).set()
+
+    async def aclose(self):
+        """Stop accepting requests; run() returns once the submitted batches finish."""
+        await self.send_channel.aclose()
+
+
+def find_tagged(text: str, open_tag: str, close_tag: str) -> str | None:
+    """Return the text between the first open_tag and the next close_tag, or None if either is missing."""
+    start = text.find(open_tag)
+    if start < 0:
+        return None
+    start += len(open_tag)
+    end = text.find(close_tag, start)
+    if end < 0:
+        return None
+    return text[start:end]
 
 
 def extract_completion(
-    text: str, model_name: str = None, is_continuation: bool = False
+    text: str, model: AIModel = None, is_continuation: bool = False
 ) -> str:
-    match = re.search(r"<completion>(.*?)</completion>", text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
+    completion = find_tagged(text, "<completion>", "</completion>")
+    if completion is not None:
+        return completion.strip()
     else:
         if (
             is_continuation
         ):  # Only count missing tags as warnings for continuation prompts
-            if model_name and model_name in warning_counts:
-                warning_counts[model_name] += 1
+            if model is not None:
+                warning_counts[model.id] += 1
             log(
-                f"Warning: No <completion> tags found in continuation response from {model_name if model_name else 'unknown model'}"
+                f"Warning: No <completion> tags found in continuation response from {model.model_name if model else 'unknown model'}"
             )
         return text.strip()
 
 
 def parse_ranking(response: str) -> list[int]:
-    try:
-        ranking_text = response.split("<ranking>")[1].split("</ranking>")[0].strip()
-        ranking = [
-            int(line.split(".")[1].strip())
-            for line in ranking_text.split("\n")
-            if line.strip()
-        ]
-        return ranking
-    except Exception as e:
-        log(f"Error parsing ranking response: {e}")
+    ranking_text = find_tagged(response, "<ranking>", "</ranking>")
+    if ranking_text is None:
+        log("Error parsing ranking response: no <ranking> tags found")
         return []
+    lines = [line for line in ranking_text.splitlines() if line.strip()]
+    matches = [RANK_LINE_RE.fullmatch(line) for line in lines]
+    # Dropping a line would shift every later candidate up a rank, so reject it all
+    if not all(matches):
+        bad_lines = [line for line, match in zip(lines, matches) if match is None]
+        log(f"Error parsing ranking response: malformed lines {bad_lines}")
+        return []
+    return [int(match.group(1)) for match in matches]
+
+
+def read_prompt_records(path: str) -> list[dict]:
+    """Load the per-prompt results written so far, or [] if there are none yet."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            # Records are written with their newline, so a crash cut this one short.
+            # Cut it off too, or the next record would be appended onto it.
+            log(f"Dropping incomplete last line of {path}")
+            os.truncate(path, len(data) - len(line))
+            break
+        records.append(orjson.loads(line))
+    return records
+
+
+def summarize_performance(guesses: list[dict]) -> pd.DataFrame:
+    """Per-model guessing and fooling stats from the guess records, indexed by model name."""
+    df = pd.DataFrame(
+        guesses,
+        columns=[
+            "guessing_model",
+            "original_model",
+            "guessed_model",
+            "rank_of_correct",
+        ],
+    )
+    correct = df["guessed_model"] == df["original_model"]
+    fooled = df[~correct & df["guessed_model"].notna()]
+    summary = pd.concat(
+        {
+            "correct_guesses": correct.groupby(df["guessing_model"]).sum(),
+            "times_guessed_correctly": correct.groupby(df["original_model"]).sum(),
+            "times_fooled_others": fooled.groupby("guessed_model").size(),
+        },
+        axis=1,
+    )
+    ranks = df.groupby("guessing_model")["rank_of_correct"].agg(
+        average_rank="mean", rank_std="std"
+    )
+    return summary.join(ranks).reindex(model_names).fillna(0)
 
 
-def print_fooling_results(results: dict):
+def print_fooling_results():
     log("\nInterim fooling results:")
     log(
         "| Model                    | Times Fooled Others | Times Got Fooled | Success Rate |"
@@ -115,14 +457,9 @@ def print_fooling_results(results: dict):
     log(
         "|--------------------------|-------------------:|----------------:|-------------:|"
     )
-    for model_name in results["model_performance"]:
-        perf = results["model_performance"][model_name]
-        times_fooled_others = perf["times_fooled_others"]
-        # Times got fooled = total guesses - correct guesses
-        total_guesses = len(perf["average_rank"])
-        times_got_fooled = (
-            total_guesses - perf["correct_guesses"] if total_guesses > 0 else 0
-        )
+    for model_name, times_fooled_others, times_got_fooled in zip(
+        model_names, fooled_others_counts.tolist(), got_fooled_counts.tolist()
+    ):
         success_rate = (
             times_fooled_others / times_got_fooled if times_got_fooled > 0 else 0
         )
@@ -132,88 +469,119 @@ def print_fooling_results(results: dict):
         )
 
 
+def continuation_prompt(prompt: str, first_half: str) -> tuple[str, str]:
+    """The continuation request as (prefix shared by every continuer, instructions)."""
+    return (
+        f"Continue this story, keeping in mind the original prompt: '{prompt}'\n\nHere's the first half of the story:\n\n{first_half}",
+        "\n\nNow continue the story from where it left off. If the first half ended mid-word, pick up from the middle of the word. Put your completion in <completion></completion> tags.",
+    )
+
+
+async def run_stage(
+    stage: str, requests: list[tuple[list[dict], AIModel, bool]]
+) -> list[str]:
+    """Run (messages, model, is_continuation) requests concurrently, returning completions in request order."""
+    completions = [None] * len(requests)
+
+    async def fetch(slot, messages, model, is_continuation):
+        completions[slot] = await get_claude_completion(
+            messages, model, is_continuation, stage
+        )
+
+    async with trio.open_nursery() as nursery:
+        for slot, request in enumerate(requests):
+            nursery.start_soon(fetch, slot, *request)
+    return completions
+
+
 async def process_prompt(
-    limiter: trio.CapacityLimiter,
     prompt_tuple: tuple[str, int],
-    models: list[AIModel],
+    writer_models: list[AIModel],
+    judge_models: list[AIModel],
     results: dict,
+    results_file,
+    rng: np.random.Generator,
 ):
-    global total_calls
     prompt, target_length = prompt_tuple
 
-    # Static variable to track if we've logged the first prompts
-    if not hasattr(process_prompt, "first_prompts_logged"):
-        process_prompt.first_prompts_logged = False
-        log(f"\nFirst story writing prompt:\n{prompt}\n")
-
-    # Print fooling results every 50 calls
-    if total_calls % 50 == 0:
-        print_fooling_results(results)
-
-    async with limiter:
-        # Generate original stories
-        original_stories = []
-        for model in models:
-            story = await get_claude_completion(
-                prompt, model.model_name, is_continuation=False
-            )
-            half = len(story) // 2
-            original_stories.append(
-                {
-                    "model": model.model_name,
-                    "story": story,
-                    "first_half": story[:half],
-                    "second_half": story[half:],
-                }
-            )
+    # Generate original stories
+    stories = await run_stage(
+        "story", [(user_message(prompt), model, False) for model in writer_models]
+    )
+    maybe_log_progress()
+    # Only complete prompts are saved, so give up on this one at the first
+    # failed request and let a rerun retry it
+    if None in stories:
+        log(f"Dropping prompt, a story request failed: {prompt[:60]}...")
+        return
+    # Halves are sliced from the story where needed rather than stored
+    original_stories = [
+        {
+            "model": model.model_name,
+            "story": story,
+            "half_index": len(story) // 2,
+        }
+        for model, story in zip(writer_models, stories)
+    ]
 
-        # Generate continuations
-        continuations = []
-        for i, model in enumerate(models):
-            for j, original_story in enumerate(original_stories):
-                if i != j:
-                    continuation_prompt = f"Continue this story, keeping in mind the original prompt: '{prompt}'\n\nHere's the first half of the story:\n\n{original_story['first_half']}\n\nNow continue the story from where it left off. If the first half ended mid-word, pick up from the middle of the word. Put your completion in <completion></completion> tags."
-
-                    # Log the first continuation prompt
-                    if not hasattr(process_prompt, "first_continuation_logged"):
-                        process_prompt.first_continuation_logged = False
-                        log(f"\nFirst continuation prompt:\n{continuation_prompt}\n")
-                        process_prompt.first_continuation_logged = True
-
-                    continuation = await get_claude_completion(
-                        continuation_prompt, model.model_name, is_continuation=True
-                    )
-                    continuations.append(
-                        {
-                            "original_model": original_story["model"],
-                            "continuing_model": model.model_name,
-                            "continuation": continuation,
-                        }
+    # Generate continuations
+    continuation_requests = []
+    continuation_keys = []
+    for model in writer_models:
+        for writer, original_story in zip(writer_models, original_stories):
+            if model is not writer:
+                first_half = original_story["story"][: original_story["half_index"]]
+                continuation_requests.append(
+                    (
+                        user_message(*continuation_prompt(prompt, first_half)),
+                        model,
+                        True,
                     )
+                )
+                continuation_keys.append((writer, model))
+
+    continuation_texts = await run_stage("continuation", continuation_requests)
+    maybe_log_progress()
+    if None in continuation_texts:
+        log(f"Dropping prompt, a continuation request failed: {prompt[:60]}...")
+        return
+    continuations = [
+        {
+            "original_model": original_model.model_name,
+            "continuing_model": continuing_model.model_name,
+            "continuation": continuation,
+        }
+        for (original_model, continuing_model), continuation in zip(
+            continuation_keys, continuation_texts
+        )
+    ]
 
-        # Perform identification
-        for original_story in original_stories:
-            # Create list of (continuation, author) pairs
-            continuation_pairs = [
-                (original_story["second_half"], original_story["model"])
-            ] + [
-                (cont["continuation"], cont["continuing_model"])
-                for cont in continuations
-                if cont["original_model"] == original_story["model"]
-            ]
-            # Shuffle while keeping track of authors
-            random.shuffle(continuation_pairs)
-            # Split into separate lists after shuffling
-            all_continuations, continuation_authors = zip(*continuation_pairs)
-            all_continuations = list(all_continuations)
-            correct_index = all_continuations.index(original_story["second_half"])
-
-            for model in models:
-                identification_prompt = f"""Here's the first half of a story, which was written in response to this prompt: '{prompt}'
+    # Perform identification
+    identification_requests = []
+    identification_keys = []
+    for writer, original_story in zip(writer_models, original_stories):
+        # Candidate 0 is the original second half, the rest are imitations
+        story, half_index = original_story["story"], original_story["half_index"]
+        candidate_texts = [story[half_index:]]
+        authors = [writer]
+        for (original_model, continuing_model), continuation in zip(
+            continuation_keys, continuation_texts
+        ):
+            if original_model is writer:
+                candidate_texts.append(continuation)
+                authors.append(continuing_model)
+        # Shuffle by index so texts and authors stay paired
+        perm = rng.permutation(len(candidate_texts))
+        all_continuations = [candidate_texts[j] for j in perm]
+        continuation_authors = [authors[j] for j in perm]
+        correct_index = int(np.argmin(perm))  # Where candidate 0 ended up
+
+        # Everything but the guesser is shared, so build the prompt once per story
+        identification_prefix = f"""Here's the first half of a story, which was written in response to this prompt: '{prompt}'
 
     First half of the story:
 
-    {original_story['first_half']}
+    {story[:half_index]}
 
     Below are several possible continuations for this story. One of them is the original continuation. The others are imitations written by a different model. Please rank these continuations from most likely to be the original (1) to least likely (n).
 
@@ -228,124 +596,225 @@ async def process_prompt(
     Here are the continuations:
 
     """
-                for i, continuation in enumerate(all_continuations, 1):
-                    identification_prompt += f"{i}. {continuation}\n\n"
-
-                ranking_response = await get_claude_completion(
-                    identification_prompt, model.model_name
+        candidates = "".join(
+            f"{i}. {continuation}\n\n"
+            for i, continuation in enumerate(all_continuations, 1)
+        )
+        identification_message = user_message(identification_prefix, candidates)
+
+        for model in judge_models:
+            identification_requests.append((identification_message, model, False))
+            identification_keys.append(
+                (
+                    model,
+                    original_story,
+                    all_continuations,
+                    continuation_authors,
+                    correct_index,
                 )
-                ranking = parse_ranking(ranking_response)
-
-                if ranking:
-                    guess = ranking[0]
-                    rank_of_correct = (
-                        ranking.index(correct_index + 1) + 1
-                        if correct_index + 1 in ranking
-                        else len(ranking)
-                    )
-
-                    results["guesses"].append(
-                        {
-                            "guessing_model": model.model_name,
-                            "original_model": original_story["model"],
-                            "ranking": ranking,
-                            "correct_index": correct_index + 1,
-                            "rank_of_correct": rank_of_correct,
-                        }
-                    )
+            )
 
-                    results["model_performance"][model.model_name][
-                        "average_rank"
-                    ].append(rank_of_correct)
-
-                    if guess == correct_index + 1:
-                        results["model_performance"][model.model_name][
-                            "correct_guesses"
-                        ] += 1
-                        results["model_performance"][original_story["model"]][
-                            "times_guessed_correctly"
-                        ] += 1
-                        log(
-                            f"{model.model_name} correctly guessed {original_story['model']}'s story (rank {rank_of_correct})"
-                        )
-                    elif 1 <= guess <= len(all_continuations):
-                        # Now we can correctly attribute who fooled whom
-                        fooled_by_model = continuation_authors[guess - 1]
-                        results["model_performance"][fooled_by_model][
-                            "times_fooled_others"
-                        ] += 1
-                        log(
-                            f"{model.model_name} was fooled by {fooled_by_model}'s continuation (rank {rank_of_correct})"
-                        )
-                    else:
-                        log(f"Warning: Invalid guess {guess} from {model.model_name}")
-                else:
-                    log(
-                        f"Warning: Could not parse ranking response from {model.model_name}"
-                    )
+    ranking_responses = await run_stage("identification", identification_requests)
+    if None in ranking_responses:
+        log(f"Dropping prompt, an identification request failed: {prompt[:60]}...")
+        maybe_log_progress()
+        return
+    guesses = []
+    for (
+        model,
+        original_story,
+        all_continuations,
+        continuation_authors,
+        correct_index,
+    ), ranking_response in zip(identification_keys, ranking_responses):
+        ranking = parse_ranking(ranking_response)
+
+        if ranking:
+            guess = ranking[0]
+            # Invert the ranking once: candidate number -> rank (first mention wins)
+            rank_of = {}
+            for rank, candidate in enumerate(ranking, 1):
+                rank_of.setdefault(candidate, rank)
+            rank_of_correct = rank_of.get(correct_index + 1, len(ranking))
+            # Author of the continuation picked as the original
+            guessed_model = (
+                continuation_authors[guess - 1]
+                if 1 <= guess <= len(all_continuations)
+                else None
+            )
 
-        results["prompts"].append(
-            {
-                "prompt_text": prompt,
-                "target_length": target_length,
-                "original_stories": original_stories,
-                "continuations": continuations,
+            guess_record = {
+                "guessing_model": model.model_name,
+                "original_model": original_story["model"],
+                "guessed_model": (guessed_model.model_name if guessed_model else None),
+                "ranking": ranking,
+                "correct_index": correct_index + 1,
+                "rank_of_correct": rank_of_correct,
             }
-        )
+            guesses.append(guess_record)
+
+            if guess == correct_index + 1:
+                log(
+                    f"{model.model_name} correctly guessed {original_story['model']}'s story (rank {rank_of_correct})"
+                )
+            elif guessed_model is not None:
+                # Now we can correctly attribute who fooled whom
+                log(
+                    f"{model.model_name} was fooled by {guessed_model.model_name}'s continuation (rank {rank_of_correct})"
+                )
+            else:
+                log(f"Warning: Invalid guess {guess} from {model.model_name}")
+        else:
+            log(f"Warning: Could not parse ranking response from {model.model_name}")
+
+    results["guesses"].extend(guesses)
+    for guess_record in guesses:
+        count_guess(guess_record)
+    maybe_log_progress()
+
+    # Write this prompt's results out now rather than holding them until the end
+    record = {
+        "prompt_text": prompt,
+        "target_length": target_length,
+        "original_stories": original_stories,
+        "continuations": continuations,
+        "guesses": guesses,
+    }
+    await results_file.write(orjson.dumps(record) + b"\n")
+    await results_file.flush()
 
 
 async def star_chameleon(
-    models: list[AIModel], prompts: list[tuple[str, int]], num_prompts: int = 2
+    writer_models: list[AIModel],
+    prompts: list[tuple[str, int]],
+    num_prompts: int = 2,
+    judge_models: list[AIModel] | None = None,
 ):
+    """Writers write and continue each other's stories, judges rank the continuations (default: just the first writer)."""
     # Initialize counters
     global \
+        batch_scheduler, \
+        response_cache, \
+        model_names, \
+        model_ids, \
         warning_counts, \
         total_calls, \
         total_expected_calls, \
+        progress_checkpoint, \
         calls_per_model, \
-        continuation_calls_per_model
-    warning_counts = {model.model_name: 0 for model in models}
-    calls_per_model = {model.model_name: 0 for model in models}
-    continuation_calls_per_model = {model.model_name: 0 for model in models}
+        continuation_calls_per_model, \
+        fooled_others_counts, \
+        got_fooled_counts
+    if judge_models is None:
+        judge_models = writer_models[:1]
+    # Judges need not be writers, so number every distinct model
+    models = writer_models + [
+        model for model in judge_models if model not in writer_models
+    ]
+    for model_id, model in enumerate(models):
+        model.id = model_id
+    model_names = [model.model_name for model in models]
+    model_ids = {model.model_name: model.id for model in models}
+    warning_counts = np.zeros(len(models), dtype=np.int64)
+    calls_per_model = np.zeros(len(models), dtype=np.int64)
+    continuation_calls_per_model = np.zeros(len(models), dtype=np.int64)
+    fooled_others_counts = np.zeros(len(models), dtype=np.int64)
+    got_fooled_counts = np.zeros(len(models), dtype=np.int64)
     total_calls = 0
+    progress_checkpoint = 0
 
-    # Calculate total expected calls
-    n = len(models)
-    total_expected_calls = num_prompts * (
-        n + n * (n - 1) + n * n
-    )  # Initial stories + continuations + identifications
+    # Shuffle prompt indices with a fixed seed so reruns pick the same prompts
+    rng = random.Random(SEED)
+    order = list(range(len(prompts)))
+    rng.shuffle(order)
 
+    # Resume from any prompts a previous run already finished
     results = {
-        "prompts": [],
+        "judge_models": [model.model_name for model in judge_models],
         "guesses": [],
-        "model_performance": {
-            model.model_name: {
-                "correct_guesses": 0,
-                "times_guessed_correctly": 0,
-                "times_fooled_others": 0,
-                "average_rank": [],
-            }
-            for model in models
-        },
     }
+    selected = {prompts[i][0] for i in order[:num_prompts]}
+    finished = set()
+    for record in read_prompt_records(RESULTS_JSONL_PATH):
+        # The file may hold prompts from a bigger run; only count this run's
+        if record["prompt_text"] not in selected:
+            continue
+        finished.add(record["prompt_text"])
+        results["guesses"].extend(record["guesses"])
+        for guess in record["guesses"]:
+            count_guess(guess)
+    pending = [i for i in order[:num_prompts] if prompts[i][0] not in finished]
+    if finished:
+        log(
+            f"Resuming from {RESULTS_JSONL_PATH}: {num_prompts - len(pending)} prompts already done"
+        )
 
-    log(f"Starting evaluation with {num_prompts} prompts...")
+    # Calculate total expected calls
+    n = len(writer_models)
+    calls_per_prompt = (
+        n + n * (n - 1) + n * len(judge_models)
+    )  # Initial stories + continuations + identifications
+    total_expected_calls = len(pending) * calls_per_prompt
+
+    log(f"Starting evaluation with {len(pending)} prompts...")
     log(
-        f"Total expected API calls: {total_expected_calls} ({n} models, {2*n*n} calls per prompt)"
+        f"Total expected API calls: {total_expected_calls} ({n} writers, {len(judge_models)} judges, {calls_per_prompt} calls per prompt)"
     )
 
-    async with trio.open_nursery() as nursery:
-        limiter = trio.CapacityLimiter(CAPACITY_LIMIT)
-        for prompt in random.sample(prompts, k=num_prompts):
-            nursery.start_soon(process_prompt, limiter, prompt, models, results)
-
-    # Calculate average ranks
-    for model in results["model_performance"]:
-        ranks = results["model_performance"][model]["average_rank"]
-        results["model_performance"][model]["average_rank"] = (
-            sum(ranks) / len(ranks) if ranks else 0
+    # Show what the models will be asked, once, before any requests go out
+    if pending:
+        first_prompt = prompts[pending[0]][0]
+        log(f"\nFirst story writing prompt:\n{first_prompt}\n")
+        log(
+            f"\nFirst continuation prompt:\n{''.join(continuation_prompt(first_prompt, '[first half of the story]'))}\n"
         )
 
+    if RESPONSE_CACHE_PATH:
+        response_cache = shelve.open(RESPONSE_CACHE_PATH)
+
+    try:
+        async with trio.open_nursery() as nursery:
+            if USE_BATCH_API:
+                batch_scheduler = BatchScheduler()
+                nursery.start_soon(batch_scheduler.run)
+
+            async with (
+                await trio.open_file(RESULTS_JSONL_PATH, "ab") as results_file,
+                trio.open_nursery() as prompt_nursery,
+            ):
+                for i in pending:
+                    prompt_nursery.start_soon(
+                        process_prompt,
+                        prompts[i],
+                        writer_models,
+                        judge_models,
+                        results,
+                        results_file,
+                        # Per-prompt stream, so shuffles don't depend on task timing
+                        np.random.default_rng([SEED, i]),
+                    )
+
+            if batch_scheduler is not None:
+                await batch_scheduler.aclose()
+    finally:
+        # Reset even on failure, or a later run would queue requests on a dead scheduler
+        batch_scheduler = None
+        if response_cache is not None:
+            response_cache.close()
+            response_cache = None
+
+    # Per-model summaries with average ranks, computed from the guess records
+    results["model_performance"] = {
+        model_name: {
+            "correct_guesses": int(row["correct_guesses"]),
+            "times_guessed_correctly": int(row["times_guessed_correctly"]),
+            "times_fooled_others": int(row["times_fooled_others"]),
+            "average_rank": float(row["average_rank"]),
+            "rank_std": float(row["rank_std"]),
+        }
+        for model_name, row in summarize_performance(results["guesses"]).iterrows()
+    }
+
     return results
 
 
@@ -493,13 +962,19 @@ async def main():
     ]
 
     unique_prompts = generate_unique_prompts()
-    results = await star_chameleon(models, unique_prompts, len(unique_prompts))
+    # Every model judges too; pass judge_models=models[:1] for a cheaper run
+    results = await star_chameleon(
+        models, unique_prompts, len(unique_prompts), judge_models=models
+    )
 
     log("Saving results to JSON file...")
-    with open("star_chameleon_results.json", "w") as f:
-        json.dump(results, f, indent=2)
+    prompt_records = read_prompt_records(RESULTS_JSONL_PATH)
+    for record in prompt_records:
+        del record["guesses"]  # Already collected in results["guesses"]
+    with open(RESULTS_PATH, "wb") as f:
+        f.write(orjson.dumps({"prompts": prompt_records, **results}))
 
-    log("Results saved to star_chameleon_results.json")
+    log(f"Results saved to {RESULTS_PATH}")
 
     log("Model Performance Summary:")
     for model, performance in results["model_performance"].items():